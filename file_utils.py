@@ -1,6 +1,7 @@
 import hail as hl
 import logging
-from typing import Tuple
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
 
 from gnomad.resources.config import (
     gnomad_public_resource_configuration,
@@ -9,6 +10,7 @@ from gnomad.resources.config import (
 from gnomad.resources.grch37.gnomad import public_release as v2_public_release
 from gnomad.resources.grch38.gnomad import public_release as v3_public_release
 from gnomad.resources.resource_utils import DataException
+from gnomad.utils.file_utils import file_exists
 
 logging.basicConfig(
     format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
@@ -21,18 +23,66 @@ gnomad_public_resource_configuration.source = (
     GnomadPublicResourceSource.GOOGLE_CLOUD_PUBLIC_DATASETS
 )
 
-
-def load_public_resources() -> Tuple[hl.Table, hl.Table, hl.Table]:
+def load_public_resources(
+    v2_genomes_fields: Optional[Tuple[str, ...]] = None,
+    v3_genomes_fields: Optional[Tuple[str, ...]] = None,
+    liftover_cache_path: str = "gs://gnomad-tmp/review-hum-mut/gnomad.exomes.r2.1.1.sites.liftover_grch38.keyed_by_original.ht",
+) -> Tuple[hl.Table, hl.Table, hl.Table]:
     '''
     Return public resources for v2 genomes, v3 genomes, and v2 liftover variants.
+
+    The v2 exome liftover Table is re-keyed by `original_locus` and `original_alleles` and written to `liftover_cache_path` the first time it is needed. Later calls read the cached copy and skip the re-key shuffle.
+
+    :param v2_genomes_fields: Row fields to keep on the v2 genomes Table. All fields are kept if None
+    :param v3_genomes_fields: Row fields to keep on the v3 genomes Table. All fields are kept if None
+    :param liftover_cache_path: Path of the cached v2 exome liftover Table keyed by original locus and alleles
+    :return: v2 genomes, v3 genomes, and v2 exome liftover Tables
     '''
     v2_genomes_ht = v2_public_release("genomes").ht()
+    if v2_genomes_fields is not None:
+        v2_genomes_ht = v2_genomes_ht.select(*v2_genomes_fields)
     v3_genomes_ht = v3_public_release("genomes").ht()
-    v2_exome_liftover_ht = hl.read_table(
-        "gs://gcp-public-data--gnomad/release/2.1.1/liftover_grch38/ht/exomes/gnomad.exomes.r2.1.1.sites.liftover_grch38.ht"
-    )
-    logger.info("Keying v2_liftover_ht by original_locus and orignal_alleles...")
-    v2_exome_liftover_ht = v2_liftover_ht = v2_exome_liftover_ht.key_by(
-        "original_locus", "original_alleles"
-    )
+    if v3_genomes_fields is not None:
+        v3_genomes_ht = v3_genomes_ht.select(*v3_genomes_fields)
+    if not file_exists(liftover_cache_path):
+        v2_exome_liftover_ht = hl.read_table(
+            "gs://gcp-public-data--gnomad/release/2.1.1/liftover_grch38/ht/exomes/gnomad.exomes.r2.1.1.sites.liftover_grch38.ht"
+        )
+        logger.info(
+            "Keying v2_liftover_ht by original_locus and original_alleles and caching to %s...",
+            liftover_cache_path,
+        )
+        v2_exome_liftover_ht = v2_exome_liftover_ht.key_by(
+            "original_locus", "original_alleles"
+        ).select("locus", "alleles")
+        v2_exome_liftover_ht.write(liftover_cache_path, overwrite=True)
+    v2_liftover_ht = hl.read_table(liftover_cache_path)
     return v2_genomes_ht, v3_genomes_ht, v2_liftover_ht
+
+
+@contextmanager
+def gnomad_resource_source(source: GnomadPublicResourceSource) -> Iterator[None]:
+    '''
+    Temporarily set the source that gnomAD public resources are loaded from.
+
+    The previous source is restored on exit, so only resources loaded inside the block are affected.
+
+    :param source: Source to load gnomAD public resources from inside the block
+    '''
+    previous_source = gnomad_public_resource_configuration.source
+    gnomad_public_resource_configuration.source = source
+    try:
+        yield
+    finally:
+        gnomad_public_resource_configuration.source = previous_source
+
+
+def get_freq_index(ht: hl.Table, meta: Dict[str, str]) -> int:
+    '''
+    Return the index of `meta` in the `freq_meta` global annotation of `ht`.
+
+    :param ht: Hail Table with a `freq_meta` global annotation
+    :param meta: Dictionary of frequency metadata to look up, e.g. {"group": "adj"}
+    :return: Index of `meta` in `freq_meta`
+    '''
+    return hl.eval(ht.freq_meta).index(meta)
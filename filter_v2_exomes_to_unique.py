@@ -3,7 +3,7 @@ import logging
 
 import hail as hl
 
-from file_utils import load_public_resources
+from file_utils import get_freq_index, load_public_resources
 
 logging.basicConfig(
     format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
@@ -16,8 +16,9 @@ logger.setLevel(logging.INFO)
 def main(args):
     logger.info("Loading variant table, v2 genomes, v3 variants, and v2 liftover...")
     ht = hl.read_table(args.sample_with_variants_path)
-    original_count = ht.count()
-    v2_genomes_ht, v3_genomes_ht, v2_exome_liftover_ht = load_public_resources()
+    v2_genomes_ht, v3_genomes_ht, v2_exome_liftover_ht = load_public_resources(
+        v2_genomes_fields=("freq",), v3_genomes_fields=("freq",)
+    )
     v2_liftover_index = v2_exome_liftover_ht[ht.key]
     ht = ht.annotate(
         liftover_locus=v2_liftover_index.locus,
@@ -27,22 +28,27 @@ def main(args):
     logger.info(
         "Filtering variants not found in v2 genomes or v3 samples but found in v2 exomes..."
     )
-    freq_adj_idx = hl.eval(v2_genomes_ht.freq_meta.index({"group": "adj"}))
-    ht = ht.annotate(
-        v2_genomes_adj_freq=v2_genomes_ht[ht.key].freq[freq_adj_idx]
+    v2_genomes_freq_idx = get_freq_index(v2_genomes_ht, {"group": "adj"})
+    v2_genomes_ht = v2_genomes_ht.select(
+        adj_freq=v2_genomes_ht.freq[v2_genomes_freq_idx]
+    )
+    v3_non_v2_freq_idx = get_freq_index(
+        v3_genomes_ht, {"group": "adj", "subset": "non_v2"}
+    )
+    v3_genomes_ht = v3_genomes_ht.select(
+        adj_freq=v3_genomes_ht.freq[v3_non_v2_freq_idx]
     )
-    # Keep variants that are undefined.
-    ht = ht.filter(hl.or_else(ht.v2_genomes_adj_freq.AC == 0, True))
-    freq_adj_idx = hl.eval(v3_genomes_ht.freq_meta.index(
-        {"group": "adj", "subset": "non_v2"}
-    ))
     ht = ht.annotate(
-        v3_non_v2_adj_freq=v3_genomes_ht[ht.liftover_locus, ht.liftover_alleles].freq[
-            freq_adj_idx
-        ]
+        v2_genomes_adj_freq=v2_genomes_ht[ht.key].adj_freq,
+        v3_non_v2_adj_freq=v3_genomes_ht[
+            ht.liftover_locus, ht.liftover_alleles
+        ].adj_freq,
     )
     # Keep variants that are undefined.
-    ht = ht.filter(hl.or_else(ht.v3_non_v2_adj_freq.AC == 0, True))
+    ht = ht.filter(
+        hl.or_else(ht.v2_genomes_adj_freq.AC == 0, True)
+        & hl.or_else(ht.v3_non_v2_adj_freq.AC == 0, True)
+    )
 
     logger.info(
         f"Writing Hail Table to {args.output_path_prefix}/v2_exomes_unique_samples_with_variants.ht"
@@ -51,14 +57,16 @@ def main(args):
         f"{args.output_path_prefix}/v2_exomes_unique_samples_with_variants.ht",
         overwrite=args.overwrite,
     )
+    original_count = hl.read_table(args.sample_with_variants_path).count()
     logger.info(f"{original_count} variants were filtered to {ht.count()} variants.")
     if args.overwrite:
         logger.info(
-            f"Writing TSV to {args.output_path_prefix}/v2_exomes_unique_samples_with_variants.tsv"
+            f"Writing TSV shards to {args.output_path_prefix}/v2_exomes_unique_samples_with_variants.tsv.bgz"
         )
         ht.export(
-            f"{args.output_path_prefix}/v2_exomes_unique_samples_with_variants.tsv",
+            f"{args.output_path_prefix}/v2_exomes_unique_samples_with_variants.tsv.bgz",
             header=True,
+            parallel="separate_header",
         )
 
 
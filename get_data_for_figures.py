@@ -1,7 +1,7 @@
 import argparse
 import logging
 import random
-from typing import List, Set, Tuple
+from typing import Dict, List, Tuple, Union
 
 import hail as hl
 from hail.expr.functions import is_missing
@@ -22,7 +22,7 @@ from gnomad.utils.vep import (
 
 from gnomad_qc.v2.resources.basics import get_gnomad_data, get_gnomad_meta
 
-from file_utils import load_public_resources
+from file_utils import gnomad_resource_source, load_public_resources
 
 logging.basicConfig(
     format="%(asctime)s (%(name)s %(lineno)s): %(message)s",
@@ -44,48 +44,53 @@ LOF_VEP = {
 }
 MISSENSE_INDEL_VEP = {"missense_variant", "inframe_insertion", "inframe_deletion"}
 SYNONYMOUS_VEP = {"synonymous_variant"}
+LOF_VEP_EXPR = hl.literal(LOF_VEP, dtype=hl.tset(hl.tstr))
+MISSENSE_INDEL_VEP_EXPR = hl.literal(MISSENSE_INDEL_VEP, dtype=hl.tset(hl.tstr))
+SYNONYMOUS_VEP_EXPR = hl.literal(SYNONYMOUS_VEP, dtype=hl.tset(hl.tstr))
 
 
-def get_random_subset(meta_ht: hl.Table, n: int, pop: str) -> List[str]:
+def get_random_subset(pop_samples: Dict[str, List[str]], n: int, pop: str) -> List[str]:
     """
-    Return a random subset of `n` samples from population `pop` defined by pop in the `meta_ht`.
+    Return a random subset of `n` samples from population `pop` defined by pop in `pop_samples`.
 
-    :param meta_ht: Sample metadata table
+    :param pop_samples: Dictionary of population to the list of samples in that population
     :param n: Size of random sample sample
     :param pop: Population to select from
     :return: List of random samples
     """
-    subpop_ht = meta_ht.filter(meta_ht.pop == pop)
-    subpop_samples = subpop_ht.s.collect()
+    subpop_samples = pop_samples.get(pop, [])
 
     if len(subpop_samples) >= n:
-        vals = random.sample(range(len(subpop_samples)), n)
-        rand_samples = [subpop_samples[x] for x in vals]
-        return rand_samples
+        return random.sample(subpop_samples, n)
     else:
         raise ValueError(
             f"There are fewer total samples than the requested random sample size in the population: {pop}."
         )
 
 
-def filter_to_samples(mt: hl.MatrixTable, samples: Set[str]) -> hl.MatrixTable:
+def filter_to_samples(
+    mt: hl.MatrixTable, samples_ht: hl.Table, check: bool = False
+) -> hl.MatrixTable:
     """
-    Filter a MatrixTable to a specific set of samples found in `samples`.
+    Filter a MatrixTable to a specific set of samples found in `samples_ht`.
 
     :param mt: MatrixTable to filter
-    :param samples: Set of specific samples in `mt` to filter to
-    :return: MatrixTable `mt` filtered to samples in `samples`
+    :param samples_ht: Table of specific samples in `mt` to filter to, keyed by `s`
+    :param check: Whether to check that every sample in `samples_ht` was found in `mt`. This requires counting the columns of `mt`, so it is off by default
+    :return: MatrixTable `mt` filtered to samples in `samples_ht`
     """
-    mt = mt.filter_cols(hl.literal(samples).contains(mt.s))
-    if len(samples) != mt.count_cols():
-        raise ValueError(
-            f"The number of samples {len(samples)} does not equal the number of selected columns from the supplied matrix table:  {mt.count_cols()}"
-        )
-    else:
-        return mt
+    mt = mt.semi_join_cols(samples_ht)
+    if check:
+        n_samples = samples_ht.count()
+        n_cols = mt.count_cols()
+        if n_samples != n_cols:
+            raise ValueError(
+                f"The number of samples {n_samples} does not equal the number of selected columns from the supplied matrix table:  {n_cols}"
+            )
+    return mt
 
 
-def get_random_samples_of_populations(mt: hl.MatrixTable, meta_ht: hl.Table, pops: List[str], n: int) -> Tuple[hl.Table, hl.MatrixTable]:
+def get_random_samples_of_populations(mt: hl.MatrixTable, meta_ht: hl.Table, pops: List[str], n: int, check: bool = False) -> Tuple[hl.Table, hl.MatrixTable]:
     """
     Get a random sample of `n` columns in `mt` from each population in `pops`.
 
@@ -93,17 +98,32 @@ def get_random_samples_of_populations(mt: hl.MatrixTable, meta_ht: hl.Table, pop
     :param meta_ht: Sample metadata Table
     :param pops: List of populations to select samples from
     :param n: Number of samples to select from each population
+    :param check: Whether to check that all randomly selected samples are found in `mt`
+    :return: `meta_ht` and `mt` filtered to the randomly selected samples, with `mt` columns annotated with `pop`
     """
+    # Lists are sorted so the random sample is reproducible regardless of aggregation order.
+    pop_samples = meta_ht.aggregate(
+        hl.agg.group_by(meta_ht.pop, hl.agg.collect(meta_ht.s))
+    )
+    pop_samples = {pop: sorted(samples) for pop, samples in pop_samples.items()}
     selected_samples = set([])
     for pop in pops:
-        random_samples = get_random_subset(meta_ht, n, pop)
+        random_samples = get_random_subset(pop_samples, n, pop)
         selected_samples |= set(random_samples)
-    mt = filter_to_samples(mt, selected_samples)
-    meta_ht = meta_ht.filter(hl.literal(selected_samples).contains(meta_ht.s))
+    samples_ht = hl.Table.parallelize(
+        [{"s": s} for s in sorted(selected_samples)],
+        hl.tstruct(s=hl.tstr),
+        key="s",
+    )
+    meta_ht = meta_ht.semi_join(samples_ht)
+    mt = filter_to_samples(mt, meta_ht, check)
+    mt = mt.annotate_cols(pop=meta_ht[mt.s].pop)
     return meta_ht, mt
 
 
-def filter_hardcalls_variants_interest(mt: hl.MatrixTable) -> hl.MatrixTable:
+def filter_hardcalls_variants_interest(
+    t: Union[hl.Table, hl.MatrixTable]
+) -> Union[hl.Table, hl.MatrixTable]:
     """
     Annotate variants with a `group` annotations and filter to only those in groups of interest (missense, synonymous, and pLOF).
 
@@ -112,24 +132,29 @@ def filter_hardcalls_variants_interest(mt: hl.MatrixTable) -> hl.MatrixTable:
         - Missense variants and indels. VEP annotations: missense_variant, inframe_insertion, inframe_deletion
         - Synonymous variants. VEP annotations: synonymous_variant
 
-    Must include the `most_severe_csq` and `lof` annotations on `mt`.
+    Must include the `most_severe_csq` and `lof` annotations on `t`.
 
-    :param mt: Input MatrixTable
-    :return: MatrixTable filtered to rows of interest
+    :param t: Input Table or MatrixTable
+    :return: Table or MatrixTable filtered to rows of interest
     """
-    mt = mt.annotate_rows(
-        group=hl.case()
+    group_expr = (
+        hl.case()
         .when(
-            hl.literal(LOF_VEP).contains(mt.most_severe_csq) & (mt.lof == "HC"), "LoF"
+            LOF_VEP_EXPR.contains(t.most_severe_csq) & (t.lof == "HC"), "LoF"
         )
         .when(
-            hl.literal(MISSENSE_INDEL_VEP).contains(mt.most_severe_csq),
+            MISSENSE_INDEL_VEP_EXPR.contains(t.most_severe_csq),
             "missense_indels",
         )
-        .when(hl.literal(SYNONYMOUS_VEP).contains(mt.most_severe_csq), "synonymous")
+        .when(SYNONYMOUS_VEP_EXPR.contains(t.most_severe_csq), "synonymous")
         .or_missing()
     )
-    return mt.filter_rows(hl.is_defined(mt.group))
+    if isinstance(t, hl.MatrixTable):
+        t = t.annotate_rows(group=group_expr)
+        return t.filter_rows(hl.is_defined(t.group))
+    else:
+        t = t.annotate(group=group_expr)
+        return t.filter(hl.is_defined(t.group))
 
 
 def filter_v3_1_samples(meta_ht: hl.Table) -> hl.Table:
@@ -144,20 +169,16 @@ def filter_v3_1_samples(meta_ht: hl.Table) -> hl.Table:
     ht = hl.read_table(
         "gs://gnomad/sample_qc/ht/genomes_v3.1/gnomad__v2_v3.1_new_samples_only_release_relatedness.ht"
     )
+    # Keep pairs where exactly one of the two samples is a v3 genome.
     v31_in_v2_ht = ht.filter(
-        (
-            (ht.i.data_type == "v3_genomes")
-            | (ht.j.data_type == "v3_genomes")
-            & ~(ht.i.data_type == "v3_genomes")
-            & (ht.j.data_type == "v3_genomes")
-        )
+        (ht.i.data_type == "v3_genomes") != (ht.j.data_type == "v3_genomes")
     )
 
     v31_in_v2_ht = v31_in_v2_ht.filter(v31_in_v2_ht.ibd2 > 0.4).select()
-    dup_list = hl.literal(
-        set(v31_in_v2_ht.i.s.collect()) | set(v31_in_v2_ht.j.s.collect())
-    )
-    meta_ht = meta_ht.filter(~dup_list.contains(meta_ht.s))
+    dup_ht = v31_in_v2_ht.key_by(s=v31_in_v2_ht.i.s).select()
+    dup_ht = dup_ht.union(v31_in_v2_ht.key_by(s=v31_in_v2_ht.j.s).select())
+    dup_ht = dup_ht.distinct()
+    meta_ht = meta_ht.anti_join(dup_ht)
 
     return meta_ht
 
@@ -171,6 +192,7 @@ def main(args):
         f"{tmp_path}review-hum-mut/random_samples{'_test' if args.test else ''}.ht"
     )
     random_samples_hardcalls_path = f"{tmp_path}review-hum-mut/random_samples_hardcalls{'_test' if args.test else ''}.mt"
+    filtered_meta_path = f"{tmp_path}review-hum-mut/meta_filtered{'_test' if args.test else ''}.ht"
 
     if args.use_checkpoint:
         if file_exists(random_samples_path) and file_exists(
@@ -192,142 +214,155 @@ def main(args):
                 "gs://gnomad_v2/hardcalls/hail-0.2/mt/exomes/gnomad.exomes.mt"
             )
 
+        # Only GT and the adj flag used by filter_to_adj are needed from the entries.
+        mt = mt.select_entries("GT", "adj")
+
         if args.test:
             mt = mt._filter_partitions(range(args.test_n_partitions))
+            # Loci spanned by the test partitions, used to subset the GRCh37 tables below.
+            test_intervals = [
+                hl.Interval(interval.start.locus, interval.end.locus, includes_end=True)
+                for interval in mt._calculate_new_partitions(args.test_n_partitions)
+            ]
 
         logger.info(
             "Reading in the gnomAD v2.1.1 metadata HailTable from 2018-10-11 and filtering to only release samples (releasable and pass sample QC)..."
         )
-        meta_ht = get_gnomad_meta("exomes")
+        meta_ht = get_gnomad_meta("exomes").key_by("s")
 
         # Filter metadata to release samples
         meta_ht = meta_ht.filter(meta_ht.release)
+        logger.info("Filtering duplicate samples found in the v3.1 non v2 subset...")
+        meta_ht = filter_v3_1_samples(meta_ht)
+        meta_ht = meta_ht.checkpoint(filtered_meta_path, overwrite=True)
 
         logger.info(
-            "Reading in the gnomAD v2.1.1 release sites Hail Table to annotate with VEP, freq, popmax, and variant QC filters..."
+            "Reading in the gnomAD v2.1.1 release sites Hail Table to annotate with VEP consequence, freq, popmax, and variant QC filters..."
         )
         ht = v2_public_release("exomes").ht()
+        ht = ht.select("filters", "vep", "freq", "popmax")
+        if args.test:
+            ht = hl.filter_intervals(ht, test_intervals)
+        # Filter the sites Table to variants with a v2_exomes popmax allele frequency of < 0.1% before joining.
+        # Variants with an undefined popmax are kept, see below.
+        ht = ht.filter(hl.or_else(ht.popmax[0].AF < 0.001, True))
 
-        ht_indexed = ht[mt.row_key]
-        mt = mt.annotate_rows(
-            filters=ht_indexed.filters,
-            vep=ht_indexed.vep,
-            freq=ht_indexed.freq,
-            popmax=ht_indexed.popmax,
+        logger.info(
+            "Filtering VEP to canonical transcripts only, getting the most severe consequence of the canonical transcript, and filtering to variants with a VEP consequence of interest..."
         )
+        ht = filter_vep_to_canonical_transcripts(ht)
+        ht = get_most_severe_consequence_for_summary(ht)
+        ht = filter_hardcalls_variants_interest(ht)
+        ht = ht.select(
+            "filters",
+            "freq",
+            "popmax",
+            "most_severe_csq",
+            "protein_coding",
+            "lof",
+            "no_lof_flags",
+            "group",
+        )
+        mt = mt.annotate_rows(**ht[mt.row_key])
+        mt = mt.filter_rows(hl.is_defined(mt.group))
 
         logger.info("Reading in v2 genomes, v3 genomes, and v2 liftover tables.")
-        v2_genomes_ht, v3_genomes_ht, v2_liftover_ht = load_public_resources()
+        v2_genomes_ht, v3_genomes_ht, v2_liftover_ht = load_public_resources(
+            v2_genomes_fields=("popmax",), v3_genomes_fields=("popmax",)
+        )
+        if args.test:
+            v2_genomes_ht = hl.filter_intervals(v2_genomes_ht, test_intervals)
+            v2_liftover_ht = hl.filter_intervals(v2_liftover_ht, test_intervals)
         # annotate liftover locus onto MT
         v2_liftover_index = v2_liftover_ht[mt.row_key]
         mt = mt.annotate_rows(
             liftover_locus=v2_liftover_index.locus,
             liftover_allele=v2_liftover_index.alleles,
         )
-        # Get v2 exome variants from v2 genomes and v3 genomes, and annotate their respective AF
-        v2_genomes_indexed = v2_genomes_ht[mt.row_key]
-        v3_genomes_indexed = v3_genomes_ht[mt.liftover_locus, mt.liftover_allele]
         logger.info(
             "Filtering to variants with a popmax allele frequency of less than .001 (0.1%) in v2_exomes, AND v2_genomes, AND v3_genomes..."
         )
         # Filter to only variants with a popmax allele frequency of < 0.1% in v2_exomes, AND v2_genomes, AND v3_genomes
         # Because popmax AF is used, there are some v2 variants that return NA for popmax.
         # These variants should still be kept - to avoid losing variants that are only found in non-popmax populations, or are undefined in v2 genomes and v3 genomes, but exist in v2 exomes.
+        # The v2_exomes popmax filter was already applied to the sites Table above.
+        # Only variants that are common in v2 genomes or v3 genomes are removed.
+        v2_genomes_common_ht = v2_genomes_ht.filter(
+            ~hl.or_else(v2_genomes_ht.popmax[0].AF < 0.001, True)
+        ).select()
+        v3_genomes_common_ht = v3_genomes_ht.filter(
+            ~hl.or_else(v3_genomes_ht.popmax.AF < 0.001, True)
+        ).select()
         mt = mt.filter_rows(
-            hl.or_else(mt.popmax[0].AF < 0.001, True)
-            & hl.or_else(v2_genomes_indexed.popmax[0].AF < 0.001, True)
-            & hl.or_else(v3_genomes_indexed.popmax.AF < 0.001, True)
+            hl.is_missing(v2_genomes_common_ht[mt.row_key])
+            & hl.is_missing(
+                v3_genomes_common_ht[mt.liftover_locus, mt.liftover_allele]
+            )
+        )
+        meta_ht, mt = get_random_samples_of_populations(
+            mt, meta_ht, EXOME_POPS, 100, check=args.test
         )
-        logger.info("Filtering duplicate samples found in the v3.1 non v2 subset...")
-        meta_ht = filter_v3_1_samples(meta_ht)
-        meta_ht, mt = get_random_samples_of_populations(mt, meta_ht, EXOME_POPS, 100)
         meta_ht = meta_ht.checkpoint(random_samples_path, overwrite=args.overwrite)
         mt = mt.checkpoint(random_samples_hardcalls_path, overwrite=args.overwrite)
-    
-    # Currently filter_low_conf_regions is trying to access a resource (lcr_regions) that's in a gnomad_requester_pays_bucket - cannot access it through google cloud.
-    gnomad_public_resource_configuration.source = GnomadPublicResourceSource.GNOMAD
-    logger.info(
-        "Filtering to PASS variants present in randomly sampled individuals, removing low confidence regions, and filtering VEP to canonical transcripts only..."
-    )
-    mt = mt.filter_rows(
-        hl.is_defined(mt.filters) 
-        & (hl.len(mt.filters) == 0)
-        & hl.agg.any(mt.GT.is_non_ref())
-    )
 
-    mt = filter_low_conf_regions(mt)
-    mt = filter_vep_to_canonical_transcripts(mt)
+    # Only a small fraction of rows survive the filters above.
+    mt = mt.naive_coalesce(max(1, mt.n_partitions() // 64))
 
     logger.info(
-        "Getting the most severe consequence from the VEP annotation of the canonical transcript..."
+        "Filtering to PASS variants outside of low confidence regions..."
     )
-    most_severe_csq_summary_indexed = get_most_severe_consequence_for_summary(mt.rows())[
-        mt.row_key
-    ]
-    mt = mt.annotate_rows(
-        most_severe_csq=most_severe_csq_summary_indexed.most_severe_csq,
-        protein_coding=most_severe_csq_summary_indexed.protein_coding,
-        lof=most_severe_csq_summary_indexed.lof,
-        no_lof_flags=most_severe_csq_summary_indexed.no_lof_flags,
-    )  # get_most_severe_consequence_for_summary works only on tables
+    mt = mt.filter_rows(hl.is_defined(mt.filters) & (hl.len(mt.filters) == 0))
+    # Currently filter_low_conf_regions is trying to access a resource (lcr_regions) that's in a gnomad_requester_pays_bucket - cannot access it through google cloud.
+    with gnomad_resource_source(GnomadPublicResourceSource.GNOMAD):
+        mt = filter_low_conf_regions(mt)
 
     logger.info(
-        "Filtering genotypes to adj and the matrix table to variants with at least one non ref after adj filtering..."
+        "Filtering genotypes to adj and the matrix table to variants with at least one non ref in randomly sampled individuals after adj filtering..."
     )
+    # Adj filtering only sets genotypes to missing, so one non ref check after it is enough.
     mt = filter_to_adj(mt)
-    mt = mt.filter_rows(
-        hl.agg.any(mt.GT.is_non_ref())
-    ) 
-    logger.info(
-        "Annotating and filtering the MT to only to variants with a VEP consequence of interest..."
+    mt = mt.select_entries("GT")
+    mt = mt.filter_rows(hl.agg.any(mt.GT.is_non_ref()))
+    mt = mt.checkpoint(
+        f"{args.output_path_prefix}/random_samples_hardcalls_filtered{'_test' if args.test else ''}.mt",
+        overwrite=args.overwrite,
     )
-    mt = filter_hardcalls_variants_interest(mt)
 
-    mt = mt.annotate_rows(
-        samples_with_variant=hl.agg.filter(
-            mt.GT.is_non_ref(), hl.agg.collect_as_set(mt.s)
-        )
-    )
-    ht = mt.rows()
+    ht = mt.filter_entries(mt.GT.is_non_ref()).entries()
+    ht = ht.key_by("locus", "alleles")
     ht = ht.select(
-        "samples_with_variant",
+        samples_with_variant=ht.s,
         VEP=ht.most_severe_csq,
         group=ht.group,
-        variant=hl.str(ht.locus) + "-" + hl.delimit(ht.alleles, "-"),
+        variant=hl.format(
+            "%s:%d-%s",
+            ht.locus.contig,
+            ht.locus.position,
+            hl.delimit(ht.alleles, "-"),
+        ),
         AC=ht.freq[0].AC,
         AF=ht.freq[0].AF,
         AN=ht.freq[0].AN,
         popmax_AC=ht.popmax[0].AC,
         popmax_AF=ht.popmax[0].AF,
         popmax_AN=ht.popmax[0].AN,
+        pop=ht.pop,
     )
-    ht = ht.explode("samples_with_variant")
-    random_samples_pop_map = hl.dict(hl.zip(meta_ht.s.collect(), meta_ht.pop.collect()))
-    ht = ht.annotate(
-        pop=random_samples_pop_map[ht.samples_with_variant]
-    )  # does not require a shuffle this way
 
     meta_ht.write(
         f"{args.output_path_prefix}/random_samples_metadata{'_test' if args.test else ''}.ht",
         overwrite=args.overwrite,
     )
-    mt.write(
-        f"{args.output_path_prefix}/random_samples_hardcalls_filtered{'_test' if args.test else ''}.mt",
-        overwrite=args.overwrite,
-    )
-    ht.write(
-        f"{args.output_path_prefix}/samples_with_variants{'_test' if args.test else ''}.ht",
-        overwrite=args.overwrite,
-    )
+    samples_with_variants_path = f"{args.output_path_prefix}/samples_with_variants{'_test' if args.test else ''}.ht"
+    ht = ht.checkpoint(samples_with_variants_path, overwrite=args.overwrite)
     if args.overwrite:
         ht.export(
-            f"{args.output_path_prefix}/samples_with_variants{'_test' if args.test else ''}.tsv",
+            f"{args.output_path_prefix}/samples_with_variants{'_test' if args.test else ''}.tsv.bgz",
             header=True,
+            parallel="separate_header",
         )
 
-    logger.info(
-        "Wrote out table with %s rows.", ht.count()
-    )
+    logger.info("Wrote out table with %s rows.", ht.count())
 
 
 if __name__ == "__main__":